@@ -0,0 +1,134 @@
+// Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#include "helper.h"
+
+/*
+Fused version of the prologue of get_padding_offset:
+  cum_offsets_now = cumsum(max(seq_lens) - seq_lens)
+  token_num = sum(seq_lens)
+are computed in a single block, so that the caller does not need to launch
+max / subtract / cumsum / sum kernels before removing the padding.
+*/
+template <int THREADBLOCK_SIZE>
+__global__ void GetCumOffsetsKernel(int *cum_offsets_out,
+                                    int *token_num,
+                                    const int *seq_lens,
+                                    const int bsz) {
+  typedef cub::BlockReduce<int, THREADBLOCK_SIZE> BlockReduce;
+  typedef cub::BlockScan<int, THREADBLOCK_SIZE, cub::BLOCK_SCAN_RAKING> BlockScan;
+  __shared__ union {
+    typename BlockReduce::TempStorage reduce;
+    typename BlockScan::TempStorage scan;
+  } temp_storage;
+  __shared__ int max_seq_len_shared;
+
+  const int tid = threadIdx.x;
+
+  int local_max = 0;
+  for (int i = tid; i < bsz; i += THREADBLOCK_SIZE) {
+    local_max = max_func(local_max, seq_lens[i]);
+  }
+  const int block_max = BlockReduce(temp_storage.reduce).Reduce(local_max, MaxOp<int>());
+  if (tid == 0) {
+    max_seq_len_shared = block_max;
+  }
+  __syncthreads();
+  const int max_seq_len = max_seq_len_shared;
+
+  // exclusive prefix sum of the padding of each batch, carried across chunks of THREADBLOCK_SIZE.
+  int running_offset = 0;
+  for (int base = 0; base < bsz; base += THREADBLOCK_SIZE) {
+    const int bi = base + tid;
+    const int pad = bi < bsz ? max_seq_len - seq_lens[bi] : 0;
+    int cum_offset = 0;
+    int chunk_offset = 0;
+    BlockScan(temp_storage.scan).ExclusiveSum(pad, cum_offset, chunk_offset);
+    if (bi < bsz) {
+      cum_offsets_out[bi] = running_offset + cum_offset;
+    }
+    running_offset += chunk_offset;
+    __syncthreads();
+  }
+  if (tid == 0) {
+    token_num[0] = bsz * max_seq_len - running_offset;
+  }
+}
+
+__global__ void RemovePaddingWithOffsetKernel(int64_t *output_data,
+                                              int *padding_offset,
+                                              const int64_t *input_data,
+                                              const int *seq_lens,
+                                              const int *cum_offsets,
+                                              const int sequence_length) {
+  const int bi = blockIdx.x;
+  const int tid = threadIdx.x;
+  const int cum_offset = cum_offsets[bi];
+
+  for (int i = tid; i < seq_lens[bi]; i += blockDim.x) {
+    const int tgt_seq_id = bi * sequence_length - cum_offset + i;
+    const int src_seq_id = bi * sequence_length + i;
+    output_data[tgt_seq_id] = input_data[src_seq_id];
+    padding_offset[tgt_seq_id] = cum_offset;
+  }
+}
+
+
+std::vector<paddle::Tensor> FusedGetPaddingOffset(const paddle::Tensor& input_ids,
+                                                  const paddle::Tensor& seq_len) {
+    auto cu_stream = input_ids.stream();
+    std::vector<int64_t> input_ids_shape = input_ids.shape();
+    const int bsz = seq_len.shape()[0];
+    const int seq_length = input_ids_shape[1];
+    auto cum_offsets_out = paddle::full({bsz}, 0, paddle::DataType::INT32, input_ids.place());
+    auto token_num = paddle::full({1}, 0, paddle::DataType::INT32, input_ids.place());
+    GetCumOffsetsKernel<kBlockSize><<<1, kBlockSize, 0, cu_stream>>>(
+      cum_offsets_out.data<int>(),
+      token_num.data<int>(),
+      seq_len.data<int>(),
+      bsz);
+
+    // the output size depends on token_num, so it has to be copied back to host.
+    auto cpu_token_num = token_num.copy_to(paddle::CPUPlace(), true);
+    const int token_num_data = cpu_token_num.data<int>()[0];
+    auto x_remove_padding = paddle::full({token_num_data}, 0, paddle::DataType::INT64, input_ids.place());
+    auto padding_offset = paddle::full({token_num_data}, 0, paddle::DataType::INT32, input_ids.place());
+    int blockSize = min((token_num_data + 32 - 1) / 32 * 32, 128);
+    RemovePaddingWithOffsetKernel<<<bsz, blockSize, 0, cu_stream>>>(
+      x_remove_padding.data<int64_t>(),
+      padding_offset.data<int>(),
+      input_ids.data<int64_t>(),
+      seq_len.data<int>(),
+      cum_offsets_out.data<int>(),
+      seq_length);
+    return {x_remove_padding, cum_offsets_out, padding_offset};
+}
+
+std::vector<std::vector<int64_t>> FusedGetPaddingOffsetInferShape(const std::vector<int64_t>& input_ids_shape,
+                                                                  const std::vector<int64_t>& seq_len_shape) {
+    int64_t bsz = seq_len_shape[0];
+    return {{-1}, {bsz}, {-1}};
+}
+
+std::vector<paddle::DataType> FusedGetPaddingOffsetInferDtype(const paddle::DataType& input_ids_dtype,
+                                                              const paddle::DataType& seq_len_dtype) {
+    return {input_ids_dtype, seq_len_dtype, seq_len_dtype};
+}
+
+PD_BUILD_OP(fused_get_padding_offset)
+    .Inputs({"input_ids", "seq_len"})
+    .Outputs({"x_remove_padding", "cum_offsets_out", "padding_offset"})
+    .SetKernelFn(PD_KERNEL(FusedGetPaddingOffset))
+    .SetInferShapeFn(PD_INFER_SHAPE(FusedGetPaddingOffsetInferShape))
+    .SetInferDtypeFn(PD_INFER_DTYPE(FusedGetPaddingOffsetInferDtype));
@@ -154,7 +154,8 @@ std::vector<paddle::Tensor> GetRoPE(const paddle::Tensor& input_ids,
 
     auto cu_stream = position_ids.stream();
 
-    auto rotary_embedding = paddle::full({2, batch_size, 1, max_seq_length, head_dim}, -1, paddle::DataType::FLOAT32, position_ids.place());
+    // every element is written by the kernel below, no need to fill the output first.
+    auto rotary_embedding = paddle::empty({2, batch_size, 1, max_seq_length, head_dim}, paddle::DataType::FLOAT32, position_ids.place());
 
     assert(head_dim % 2 == 0); 
     const int32_t elem_cnt = batch_size * max_seq_length * head_dim / 2; 
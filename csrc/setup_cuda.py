@@ -67,6 +67,7 @@ setup(
             "./generation/write_cache_kv.cu",
             "./generation/encode_rotary_qk.cu",
             "./generation/get_padding_offset_v2.cu",
+            "./generation/fused_get_padding_offset.cu",
             "./generation/rebuild_padding_v2.cu",
             "./generation/set_value_by_flags_v2.cu",
             "./generation/stop_generation_multi_ends_v2.cu",
@@ -457,7 +457,6 @@ class InferencePredictorMixin:
             return None
 
     def _preprocess(self, source):
-        self.attention_mask[:] = 0
         self.tgt_generation_mask[:] = 1
         pre_caches_length = 0 if not self.config.export_precache else self.pre_caches[0].shape[-2]
 
@@ -479,6 +478,7 @@ class InferencePredictorMixin:
         )
 
         if "chatglmforcausallm" == self.architectures.lower():
+            self.attention_mask[:] = 0
             if inputs["input_ids"].shape[0] < self.config.batch_size:
                 self.tgt_pos = self.tgt_pos[: inputs["input_ids"].shape[0]]
             for i in range(inputs["input_ids"].shape[0]):
@@ -501,6 +501,7 @@ class InferencePredictorMixin:
 
             inputs["tgt_pos"] = self.tgt_pos
         elif "bloom" in self.architectures:
+            self.attention_mask[:] = 0
             for i in range(inputs["input_ids"].shape[0]):
                 length = inputs["seq_len_encoder"][i][0]
                 self.attention_mask[i, :, :length, :length] = paddle.tril(
@@ -567,7 +568,21 @@ class InferencePredictorMixin:
                 alibi_decoder + (1 - self.tgt_generation_mask) * paddle.finfo(self.tgt_generation_mask.dtype).min
             )
 
+        elif pre_caches_length == 0:
+            # build the causal masks of the whole batch in one shot: position (q, k) is visible
+            # when k <= q < seq_len, which avoids one tril(ones) + slice assign per sample.
+            # unused rows get seq_len 0, so every row is overwritten and no zero fill is needed.
+            batch_size = inputs["input_ids"].shape[0]
+            seq_lens = np.zeros([self.config.batch_size, 1], dtype="int64")
+            seq_lens[:batch_size] = inputs["seq_len_encoder"]
+            seq_lens = paddle.to_tensor(seq_lens).reshape([-1, 1, 1, 1])
+            positions = paddle.arange(self.config.total_max_length, dtype="int64")
+            query_positions = positions.reshape([1, 1, -1, 1])
+            key_positions = positions.reshape([1, 1, 1, -1])
+            causal_mask = paddle.logical_and(key_positions <= query_positions, query_positions < seq_lens)
+            self.attention_mask[:] = causal_mask.astype(self.attention_mask.dtype)
         else:
+            self.attention_mask[:] = 0
             for i in range(inputs["input_ids"].shape[0]):
                 length = inputs["seq_len_encoder"][i][0]
                 self.attention_mask[i, 0, :length, :length] = paddle.tril(
@@ -1348,11 +1363,18 @@ def create_predictor(
                 )
                 model.eval()
             elif "qwen" in config.architectures[0].lower():
-                from paddlenlp.experimental.transformers import (
-                    QWenForCausalLMInferenceModel,
-                )
+                if predictor_args.block_attn:
+                    config.max_seq_len = predictor_args.total_max_length
+                    config.block_size = predictor_args.block_size
+                    from paddlenlp.experimental.transformers import (
+                        QWenForCausalLMBlockInferenceModel as QWenInferenceModel,
+                    )
+                else:
+                    from paddlenlp.experimental.transformers import (
+                        QWenForCausalLMInferenceModel as QWenInferenceModel,
+                    )
 
-                model = QWenForCausalLMInferenceModel.from_pretrained(
+                model = QWenInferenceModel.from_pretrained(
                     predictor_args.model_name_or_path,
                     config=config,
                     dtype=predictor_args.dtype,
@@ -1424,11 +1446,19 @@ def create_predictor(
                     config, predictor_args.batch_size, predictor_args.total_max_length
                 )
             elif "qwen" in config.architectures[0].lower():
-                from paddlenlp.experimental.transformers import (
-                    QWenForCausalLMInferenceModel,
-                )
+                if predictor_args.block_attn:
+                    config.block_size = predictor_args.block_size
+                    config.max_seq_len = predictor_args.total_max_length
+                    config.use_dynamic_cachekv_quant = predictor_args.use_cachekv_int8 == "dynamic"
+                    from paddlenlp.experimental.transformers import (
+                        QWenForCausalLMBlockInferenceModel as QWenInferenceModel,
+                    )
+                else:
+                    from paddlenlp.experimental.transformers import (
+                        QWenForCausalLMInferenceModel as QWenInferenceModel,
+                    )
 
-                cache_kvs_shape = QWenForCausalLMInferenceModel.get_cache_kvs_shape(
+                cache_kvs_shape = QWenInferenceModel.get_cache_kvs_shape(
                     config, predictor_args.batch_size, predictor_args.total_max_length
                 )
             else:
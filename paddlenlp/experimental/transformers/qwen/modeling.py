@@ -18,19 +18,27 @@ from __future__ import annotations
 import paddle
 from paddle import nn
 from paddle.nn.quant import weight_quantize
-from paddlenlp_ops import fused_get_rotary_embedding, get_padding_offset
+from paddlenlp_ops import (
+    fused_get_padding_offset,
+    fused_get_rotary_embedding,
+    get_padding_offset_v2,
+)
 
 from paddlenlp.experimental.transformers.fused_transformer_layers import (
+    FusedBlockMultiTransformer,
+    FusedBlockMultiTransformerWeightOnly,
     FusedMultiTransformerBase,
     FusedMultiTransformerConfig,
     FusedMultiTransformerWeightOnly,
 )
 from paddlenlp.experimental.transformers.generation_utils import (
+    GenerationBlockInferenceModel,
     GenerationInferenceModel,
 )
 from paddlenlp.transformers import QWenConfig, QWenPretrainedModel
 from paddlenlp.transformers.model_outputs import (
     BaseModelOutputWithPast,
+    BaseModelOutputWithPastAndCrossAttentions,
     CausalLMOutputWithPast,
 )
 from paddlenlp.transformers.model_utils import (
@@ -39,7 +47,7 @@ from paddlenlp.transformers.model_utils import (
 )
 from paddlenlp.transformers.qwen.modeling import QWenLMHead, QWenPretrainingCriterion
 
-__all__ = ["QWenForCausalLMInferenceModel"]
+__all__ = ["QWenForCausalLMInferenceModel", "QWenForCausalLMBlockInferenceModel"]
 
 
 class FusedQWenRMSNorm(nn.Layer):
@@ -159,17 +167,25 @@ class QWenInferenceModel(QWenPretrainedModel):
             epsilon=self.layer_norm_epsilon,
             norm_type="rmsnorm",
             use_neox_rotary_style=True,
+            use_dynamic_cachekv_quant=config.get("use_cachekv_int8", "None") == "dynamic",
         )
 
-        if self.use_weight_only:
-            self.transformer_block = FusedMultiTransformerWeightOnly(transformer_config)
-        else:
-            self.transformer_block = FusedMultiTransformerBase(transformer_config)
+        self.set_transformer_block(transformer_config)
 
         self.ln_f = FusedQWenRMSNorm(config)
 
         self.cache_kvs = None
-        self.head_dim_shape_tensor = paddle.ones((self.hidden_size // self.num_attention_heads), dtype="int8")
+        # only the shape of head_dim_shape_tensor is read by fused_get_rotary_embedding. It is not part of the
+        # checkpoints, see `_keys_to_ignore_on_load_missing` of the CausalLM inference models.
+        self.register_buffer(
+            "head_dim_shape_tensor", paddle.ones((self.hidden_size // self.num_attention_heads), dtype="int8")
+        )
+
+    def set_transformer_block(self, transformer_config):
+        if self.use_weight_only:
+            self.transformer_block = FusedMultiTransformerWeightOnly(transformer_config)
+        else:
+            self.transformer_block = FusedMultiTransformerBase(transformer_config)
 
     def get_input_embeddings(self):
         return self.wte
@@ -191,15 +207,17 @@ class QWenInferenceModel(QWenPretrainedModel):
             )
             self.transformer_block.ln_scales[idx].set_value(ln_scale)
 
-            qkv_weight = paddle.to_tensor(
-                state_dict["qwen.h.{}.attn.c_attn.weight".format(idx)].transpose([1, 0]), dtype=dtype
-            )
             if self.use_weight_only:
-                qkv_weight = paddle.transpose(qkv_weight, perm=[1, 0])
+                # weight_quantize takes the [in_features, out_features] layout of the checkpoint as is,
+                # so skip the host transpose and the device transpose back.
+                qkv_weight = paddle.to_tensor(state_dict["qwen.h.{}.attn.c_attn.weight".format(idx)], dtype=dtype)
                 qkv_quanted_weight, qkv_weight_scale = weight_quantize(qkv_weight, algo=self.quant_type)
                 self.transformer_block.qkv_weights[idx].set_value(qkv_quanted_weight)
-                self.transformer_block.qkv_weights_scale[idx].set_value(qkv_weight_scale)
+                self.transformer_block.qkv_weights_scale[idx].set_value(qkv_weight_scale.cast(dtype))
             else:
+                qkv_weight = paddle.to_tensor(
+                    state_dict["qwen.h.{}.attn.c_attn.weight".format(idx)].transpose([1, 0]), dtype=dtype
+                )
                 self.transformer_block.qkv_weights[idx].set_value(qkv_weight)
 
             qkv_bias = paddle.to_tensor(state_dict["qwen.h.{}.attn.c_attn.bias".format(idx)], dtype=dtype)
@@ -209,7 +227,7 @@ class QWenInferenceModel(QWenPretrainedModel):
             if self.use_weight_only:
                 linear_quanted_weight, linear_weight_scale = weight_quantize(linear_weight, algo=self.quant_type)
                 self.transformer_block.linear_weights[idx].set_value(linear_quanted_weight)
-                self.transformer_block.linear_weights_scale[idx].set_value(linear_weight_scale)
+                self.transformer_block.linear_weights_scale[idx].set_value(linear_weight_scale.cast(dtype))
             else:
                 self.transformer_block.linear_weights[idx].set_value(linear_weight)
 
@@ -224,7 +242,7 @@ class QWenInferenceModel(QWenPretrainedModel):
             if self.use_weight_only:
                 ffn1_quanted_weight, ffn1_weight_scale = weight_quantize(ffn1_weight, algo=self.quant_type)
                 self.transformer_block.ffn1_weights[idx].set_value(ffn1_quanted_weight)
-                self.transformer_block.ffn1_weights_scale[idx].set_value(ffn1_weight_scale)
+                self.transformer_block.ffn1_weights_scale[idx].set_value(ffn1_weight_scale.cast(dtype))
             else:
                 self.transformer_block.ffn1_weights[idx].set_value(ffn1_weight)
 
@@ -232,16 +250,12 @@ class QWenInferenceModel(QWenPretrainedModel):
             if self.use_weight_only:
                 ffn2_quanted_weight, ffn2_weight_scale = weight_quantize(ffn2_weight, algo=self.quant_type)
                 self.transformer_block.ffn2_weights[idx].set_value(ffn2_quanted_weight)
-                self.transformer_block.ffn2_weights_scale[idx].set_value(ffn2_weight_scale)
+                self.transformer_block.ffn2_weights_scale[idx].set_value(ffn2_weight_scale.cast(dtype))
             else:
                 self.transformer_block.ffn2_weights[idx].set_value(ffn2_weight)
 
     def remove_padding(self, input_ids, seq_lens_this_time):
-        cum_offsets_now = paddle.cumsum(paddle.max(seq_lens_this_time) - seq_lens_this_time)
-        token_num = paddle.sum(seq_lens_this_time)
-        ids_remove_padding, cum_offsets, padding_offset = get_padding_offset(
-            input_ids, cum_offsets_now, token_num, seq_lens_this_time
-        )
+        ids_remove_padding, cum_offsets, padding_offset = fused_get_padding_offset(input_ids, seq_lens_this_time)
         return ids_remove_padding, padding_offset, cum_offsets
 
     def forward(
@@ -281,9 +295,6 @@ class QWenInferenceModel(QWenPretrainedModel):
             batch, seq_len, hidden_dim = inputs_embeds.shape
             inputs_embeds = inputs_embeds.reshape([batch * seq_len, hidden_dim])
 
-        if past_key_values is None:
-            past_key_values = tuple([None] * self.config.num_hidden_layers)
-
         if not is_decoder:
             ids_remove_padding, padding_offset, cum_offsets = self.remove_padding(input_ids, seq_len_encoder)
         else:
@@ -310,20 +321,26 @@ class QWenInferenceModel(QWenPretrainedModel):
             input_ids, position_ids, self.head_dim_shape_tensor, position_offset, True
         )
 
+        # the masks from the predictor are already in the model dtype, only cast when they are not.
+        if attention_mask.dtype != hidden_states.dtype:
+            attention_mask = paddle.cast(attention_mask, dtype=hidden_states.dtype)
+
         with dy2st_nocheck_guard_context():
             hidden_states, _ = self.transformer_block(
                 input_ids,
                 hidden_states,
                 cum_offsets=cum_offsets,
                 padding_offset=padding_offset,
-                attn_mask=paddle.cast(attention_mask, dtype=hidden_states.dtype),
+                attn_mask=attention_mask,
                 caches=cache_kvs,
                 pre_caches=pre_caches,
                 pre_caches_length=position_offset,
                 seq_lens=seq_lens,
                 rotary_embs=new_rope,
                 rotary_emb_dims=1,
-                time_step=paddle.increment(paddle.shape(attention_mask)[-1], -1) if is_decoder else None,
+                # time_step only tells the decoder phase from the context phase inside transformer_block,
+                # so a static python int is enough and no shape/increment kernels are needed.
+                time_step=attention_mask.shape[-1] - 1 if is_decoder else None,
             )
 
         hidden_states = self.ln_f(hidden_states)
@@ -342,7 +359,76 @@ class QWenInferenceModel(QWenPretrainedModel):
         )
 
 
+class QWenBlockInferenceModel(QWenInferenceModel):
+    def __init__(self, config: QWenConfig):
+        super().__init__(config)
+        self.max_seq_len = config.max_seq_len
+        self.block_size = config.block_size
+
+    def set_transformer_block(self, transformer_config):
+        if self.use_weight_only:
+            self.transformer_block = FusedBlockMultiTransformerWeightOnly(transformer_config)
+        else:
+            self.transformer_block = FusedBlockMultiTransformer(transformer_config)
+
+    def remove_padding(self, input_ids, seq_lens_this_time):
+        cum_offsets_now = paddle.cumsum(self.max_seq_len - seq_lens_this_time)
+        token_num = paddle.sum(seq_lens_this_time)
+        ids_remove_padding, cum_offsets, padding_offset, cu_seqlens_q, cu_seqlens_k = get_padding_offset_v2(
+            input_ids, cum_offsets_now, token_num, seq_lens_this_time
+        )
+        return ids_remove_padding, padding_offset, cum_offsets, cu_seqlens_q, cu_seqlens_k
+
+    def forward(
+        self,
+        input_ids=None,
+        attention_mask=None,
+        inputs_embeds=None,
+        caches=None,
+        pre_caches=None,
+        output_attentions=False,
+        output_hidden_states=None,
+        return_dict=False,
+        **kwargs,
+    ):
+
+        seq_lens_this_time = kwargs.get("seq_lens_this_time", None)
+        rope_emb = kwargs.get("rope_emb", None)
+        ids_remove_padding, padding_offset, cum_offsets, cu_seqlens_q, cu_seqlens_k = self.remove_padding(
+            input_ids, seq_lens_this_time
+        )
+        kwargs["cu_seqlens_q"] = cu_seqlens_q
+        kwargs["cu_seqlens_k"] = cu_seqlens_k
+        kwargs["padding_offsets"] = padding_offset
+        kwargs["max_input_length"] = self.max_seq_len
+        kwargs["block_size"] = self.block_size
+
+        inputs_embeds = self.wte(ids_remove_padding)
+
+        with dy2st_nocheck_guard_context():
+            hidden_states, _ = self.transformer_block(
+                input_ids=input_ids,
+                src=inputs_embeds,
+                cum_offsets=cum_offsets,
+                attn_mask=attention_mask,
+                caches=caches,
+                pre_caches=pre_caches,
+                rotary_embs=rope_emb,
+                **kwargs,
+            )
+        hidden_states = self.ln_f(hidden_states)
+
+        return BaseModelOutputWithPastAndCrossAttentions(
+            last_hidden_state=hidden_states,
+            past_key_values=None,
+            hidden_states=None,
+            attentions=None,
+        )
+
+
 class QWenForCausalLMInferenceModel(GenerationInferenceModel, QWenPretrainedModel):
+    _keys_to_ignore_on_load_missing = [r"qwen.head_dim_shape_tensor"]
+
     def __init__(self, config: QWenConfig, **kwargs):
         super(QWenForCausalLMInferenceModel, self).__init__(config)
         self.qwen = QWenInferenceModel(config)
@@ -411,12 +497,17 @@ class QWenForCausalLMInferenceModel(GenerationInferenceModel, QWenPretrainedMode
         if cache is not None:
             input_ids = tgt_ids
             position_ids = tgt_pos
-            attention_mask = (tgt_generation_mask - 1) * 1e4
+            # tgt_generation_mask does not change between decoding steps, so the additive mask
+            # is built once after the encoder step in `update_model_kwargs_for_generation`.
+            attention_mask = kwargs.get("tgt_attention_mask", None)
+            if attention_mask is None:
+                attention_mask = paddle.scale(tgt_generation_mask, scale=1e4, bias=-1.0, bias_after_scale=False)
             # make inputs_embeds be none in decoder phase.
             # in forward function, it will be assigned according to input_ids.
             inputs_embeds = None
         else:
-            attention_mask = (attention_mask - 1) * 1e4
+            # (mask - 1) * 1e4 in a single elementwise kernel.
+            attention_mask = paddle.scale(attention_mask, scale=1e4, bias=-1.0, bias_after_scale=False)
         model_inputs = {
             "input_ids": input_ids,
             "inputs_embeds": inputs_embeds,
@@ -430,6 +521,16 @@ class QWenForCausalLMInferenceModel(GenerationInferenceModel, QWenPretrainedMode
         }
         return model_inputs
 
+    def update_model_kwargs_for_generation(self, cache, just_decoder, next_tokens, eos_token_id, model_kwargs):
+        model_kwargs = super().update_model_kwargs_for_generation(
+            cache, just_decoder, next_tokens, eos_token_id, model_kwargs
+        )
+        if cache is None:
+            model_kwargs["tgt_attention_mask"] = paddle.scale(
+                model_kwargs["tgt_generation_mask"], scale=1e4, bias=-1.0, bias_after_scale=False
+            )
+        return model_kwargs
+
     def forward(
         self,
         input_ids,
@@ -502,3 +603,143 @@ class QWenForCausalLMInferenceModel(GenerationInferenceModel, QWenPretrainedMode
             lm_head_weight = paddle.to_tensor(state_dict["lm_head.weight"], dtype=self.lm_head.weight.dtype)
             self.lm_head.weight.set_value(lm_head_weight)
         self.qwen.set_state_dict({k: state_dict[k] for k in state_dict.keys()})
+
+
+class QWenForCausalLMBlockInferenceModel(GenerationBlockInferenceModel, QWenPretrainedModel):
+    """
+    Block attention for QWen Model with pretraining tasks on top. Set `use_cachekv_int8="dynamic"`
+    in the config to store cache_kvs in int8 with per-sequence, per-head scales computed during prefill.
+    """
+
+    _keys_to_ignore_on_load_missing = [r"qwen.head_dim_shape_tensor"]
+
+    def __init__(self, config: QWenConfig):
+        super().__init__(config)
+        self.qwen = QWenBlockInferenceModel(config)
+        self.lm_head = QWenLMHead(config)
+
+    def get_output_embeddings(self):
+        return self.lm_head
+
+    def set_output_embeddings(self, new_embeddings):
+        self.lm_head = new_embeddings
+
+    @classmethod
+    def from_pretrained(
+        cls, pretrained_model_name_or_path, from_hf_hub: bool = False, subfolder: str | None = None, *args, **kwargs
+    ):
+        # TODO: Support safetensors loading.
+        kwargs["use_safetensors"] = False
+        return super().from_pretrained(pretrained_model_name_or_path, from_hf_hub, subfolder, *args, **kwargs)
+
+    @classmethod
+    def get_cache_kvs_shape(
+        cls, config: QWenConfig, max_batch_size: int = None, max_length: int = None
+    ) -> list[list[int]]:
+        """get cache_kvs tensor for qwen model
+
+        Args:
+            max_batch_size (int): the max batch size
+            max_length (int | None, optional): the max_length of cache_kvs. Defaults to None.
+
+        Returns:
+            list[paddle.Tensor]: the list tensor shape for cache
+        """
+        max_block_per_seq = (config.max_seq_len + config.block_size - 1) // config.block_size
+        if max_batch_size == -1:
+            max_block_nums = None
+        else:
+            max_block_nums = max_batch_size * max_block_per_seq
+
+        cache_kvs = []
+        for _ in range(config.num_hidden_layers):
+            cache_kv_shape = [
+                max_block_nums,
+                config.num_attention_heads // max(config.tensor_parallel_degree, 1),
+                config.block_size,
+                config.hidden_size // config.num_attention_heads,
+            ]
+            cache_kvs.append(cache_kv_shape)
+            cache_kvs.append(cache_kv_shape)
+        return cache_kvs
+
+    def prepare_inputs_for_generation(self, **kwargs):
+        # only last token for inputs_ids if cache is defined in kwargs
+        input_ids = kwargs["input_ids"]
+        src_mask = kwargs.get("src_mask", None)
+        block_tables = kwargs.get("block_tables", None)
+
+        pre_caches = kwargs.get("pre_caches", None)
+        caches = kwargs.get("caches", None)
+
+        rope_emb = kwargs["rope_emb"]
+        seq_lens_this_time = kwargs["seq_lens_this_time"]
+        seq_lens_encoder = kwargs["seq_lens_encoder"]
+        seq_lens_decoder = kwargs["seq_lens_decoder"]
+        k_quant_scales = kwargs.get("k_quant_scales", None)
+        v_quant_scales = kwargs.get("v_quant_scales", None)
+        k_dequant_scales = kwargs.get("k_dequant_scales", None)
+        v_dequant_scales = kwargs.get("v_dequant_scales", None)
+        model_inputs = {
+            "input_ids": input_ids,
+            "src_mask": src_mask,
+            "rope_emb": rope_emb,
+            "pre_caches": pre_caches,
+            "caches": caches,
+            "seq_lens_this_time": seq_lens_this_time,
+            "seq_lens_encoder": seq_lens_encoder,
+            "seq_lens_decoder": seq_lens_decoder,
+            "block_tables": block_tables,
+            "k_quant_scales": k_quant_scales,
+            "v_quant_scales": v_quant_scales,
+            "k_dequant_scales": k_dequant_scales,
+            "v_dequant_scales": v_dequant_scales,
+        }
+        return model_inputs
+
+    def forward(
+        self,
+        input_ids,
+        src_mask=None,
+        pre_caches=None,
+        caches=None,
+        seq_lens_this_time=None,
+        seq_lens_encoder=None,
+        seq_lens_decoder=None,
+        rope_emb=None,
+        block_tables=None,
+        k_quant_scales=None,
+        v_quant_scales=None,
+        k_dequant_scales=None,
+        v_dequant_scales=None,
+    ):
+        outputs = self.qwen(
+            input_ids,
+            src_mask=src_mask,
+            caches=caches,
+            rope_emb=rope_emb,
+            block_tables=block_tables,
+            pre_caches=pre_caches,
+            seq_lens_this_time=seq_lens_this_time,
+            seq_lens_encoder=seq_lens_encoder,
+            seq_lens_decoder=seq_lens_decoder,
+            k_quant_scales=k_quant_scales,
+            v_quant_scales=v_quant_scales,
+            k_dequant_scales=k_dequant_scales,
+            v_dequant_scales=v_dequant_scales,
+        )
+
+        hidden_states = outputs[0]
+        logits = self.lm_head(
+            hidden_states,
+            tensor_parallel_output=False,
+        )
+
+        return logits
+
+    @paddle.no_grad()
+    def set_state_dict(self, state_dict):
+        if "lm_head.weight" in state_dict:
+            lm_head_weight = paddle.to_tensor(state_dict["lm_head.weight"], dtype=self.lm_head.weight.dtype)
+            self.lm_head.weight.set_value(lm_head_weight)
+        self.qwen.set_state_dict({k: state_dict[k] for k in state_dict.keys()})
@@ -61,6 +61,10 @@ except:
 
 
 def parallel_matmul(x: Tensor, y: Tensor, tensor_parallel_output=True):
+    if not y.is_distributed:
+        # the weight is not split, so skip the hybrid communicate group lookup.
+        return paddle.matmul(x, y, transpose_y=False)
+
     is_fleet_init = True
     tensor_parallel_degree = 1
     try:
@@ -26,6 +26,7 @@ from paddlenlp.transformers import (  # ChatGLMForCausalLM,
     ChatGLMForCausalLM,
     ChatGLMv2ForCausalLM,
     LlamaForCausalLM,
+    QWenForCausalLM,
 )
 from paddlenlp.utils.downloader import (
     COMMUNITY_MODEL_PREFIX,
@@ -211,6 +212,7 @@ class PredictorBaseTest(LLMTest, unittest.TestCase):
     ["model_name_or_path", "model_class"],
     [
         ["__internal_testing__/tiny-fused-llama-inference5.2", LlamaForCausalLM],
+        ["__internal_testing__/tiny-fused-qwen", QWenForCausalLM],
     ],
 )
 class BlockAttnPredictorTest(LLMTest, unittest.TestCase):